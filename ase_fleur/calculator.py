@@ -4,19 +4,46 @@ This module defines a calculator for the Fleur code starting from version v27
 """
 from __future__ import annotations
 
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from contextlib import contextmanager
 from pathlib import Path
+import os
+import threading
 import warnings
 import re
-from typing import Any
+from typing import Any, Callable, Iterator
 
 from masci_tools.io.fleurxmlmodifier import FleurXMLModifier
-from masci_tools.io.parsers.fleur import outxml_parser
 
 from ase.calculators.genericfileio import GenericFileIOCalculator, CalculatorTemplate
 from ase import Atoms
 
 from ase_fleur.io import write_fleur_inpgen, read_fleur_outxml
 
+_VERSION_RE = re.compile(r"^\s*MaX\-Release (.*)\(www\.max\-centre\.eu\)", re.MULTILINE)
+
+
+@contextmanager
+def _output_fds(outputfile: Path | str, error_file: Path | str) -> Iterator[tuple[int, int]]:
+    """
+    Open the stdout/stderr files for a subprocess as plain file descriptors,
+    which are handed to the child process without Python file objects
+
+    :param outputfile: path to the file for the stdout output
+    :param error_file: path to the file for the stderr output
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    out_fd = os.open(outputfile, flags, 0o644)
+    try:
+        err_fd = os.open(error_file, flags, 0o644)
+        try:
+            yield out_fd, err_fd
+        finally:
+            os.close(err_fd)
+    finally:
+        os.close(out_fd)
+
 
 class FleurProfile:
     """
@@ -24,40 +51,103 @@ class FleurProfile:
 
     :param argv: arguments for the Fleur code
     :param inpgen_argv: arguments for the input generator for the Fleur code
+    :param submit_fn: optional callable used by :py:meth:`run_async` to submit Fleur
+                      runs to a different backend, e.g. a batch queue. It is called
+                      as ``submit_fn(argv, directory, outputfile, error_file)`` and
+                      has to return a :py:class:`concurrent.futures.Future`
     """
 
-    def __init__(self, argv: list[str], inpgen_argv: list[str]) -> None:
+    def __init__(self, argv: list[str], inpgen_argv: list[str], submit_fn: Callable[..., Future] | None = None) -> None:
         self.argv = argv
         self.inpgen_argv = inpgen_argv
+        self.submit_fn = submit_fn
+        self._version: str | None = None
 
     def version(self) -> str:
         """
         Return the version string of the fleur code in this profile
+
+        The version is only determined on the first call and cached afterwards
         """
-        from subprocess import check_output
+        if self._version is not None:
+            return self._version
+
+        from subprocess import Popen, PIPE, CalledProcessError
         import tempfile
 
+        lines = []
         with tempfile.TemporaryDirectory() as td:
             with open(Path(td) / "err", "w", encoding="utf8") as err:
-                out = check_output(self.argv + ["-info"], stderr=err, cwd=td).decode("utf-8")
-        m = re.findall(r"^\s*MaX\-Release (.*)\(www\.max\-centre\.eu\)", out, flags=re.MULTILINE)
-        if not m:
-            raise ValueError(f"Could not retrieve version from output: {out}")
-        return m[0].strip()
+                with Popen(
+                    self.argv + ["-info"], stdout=PIPE, stderr=err, cwd=td, text=True, encoding="utf-8", bufsize=1
+                ) as process:
+                    for line in process.stdout:  # type: ignore[union-attr]
+                        m = _VERSION_RE.search(line)
+                        if m is not None:
+                            # The rest of the output is not needed. SIGTERM lets launchers like mpirun clean up
+                            process.terminate()
+                            self._version = m.group(1).strip()
+                            return self._version
+                        lines.append(line)
+        out = "".join(lines)
+        if process.returncode != 0:
+            raise CalledProcessError(process.returncode, process.args, output=out)
+        raise ValueError(f"Could not retrieve version from output: {out}")
 
     def run(self, directory: Path, outputfile: Path | str, error_file: Path | str) -> None:
         """
         Run Fleur in the given directory
 
+        Relative paths for the output files are taken relative to the execution directory
+
         :param directory: path to the execution directory
         :param outputfile: path to the file for the stdout output
         :param error_file: path to the file for the stderr output
         """
-        from subprocess import check_call
+        import subprocess
+
+        directory = Path(directory)
+        with _output_fds(directory / outputfile, directory / error_file) as (out_fd, err_fd):
+            subprocess.run(self.argv, stdout=out_fd, stderr=err_fd, cwd=directory, check=True)
+
+    def run_async(self, directory: Path, outputfile: Path | str, error_file: Path | str) -> Future:
+        """
+        Start Fleur in the given directory without waiting for it to finish
 
-        with open(outputfile, "w", encoding="utf8") as fd:
-            with open(error_file, "w", encoding="utf8") as ferr:
-                check_call(self.argv, stdout=fd, stderr=ferr, cwd=directory)
+        Relative paths for the output files are taken relative to the execution
+        directory, so that multiple runs in different directories do not overwrite
+        each others output
+
+        :param directory: path to the execution directory
+        :param outputfile: path to the file for the stdout output
+        :param error_file: path to the file for the stderr output
+
+        :returns: Future, which is resolved once the Fleur process finished.
+                  A non-zero exit code is set as a CalledProcessError on the Future
+        """
+        from subprocess import Popen, CalledProcessError
+
+        directory = Path(directory)
+        if self.submit_fn is not None:
+            return self.submit_fn(self.argv, directory, directory / outputfile, directory / error_file)
+
+        future: Future[None] = Future()
+        future.set_running_or_notify_cancel()
+        with _output_fds(directory / outputfile, directory / error_file) as (out_fd, err_fd):
+            # The process is waited for in the background thread below, so no with block is used
+            process = Popen(  # pylint: disable=consider-using-with
+                self.argv, stdout=out_fd, stderr=err_fd, cwd=directory
+            )
+
+        def _wait_for_process() -> None:
+            returncode = process.wait()
+            if returncode != 0:
+                future.set_exception(CalledProcessError(returncode, self.argv))
+            else:
+                future.set_result(None)
+
+        threading.Thread(target=_wait_for_process, daemon=True).start()
+        return future
 
     def run_inpgen(
         self, directory: Path, inputfile: Path | str, outputfile: Path | str, error_file: Path | str
@@ -65,16 +155,20 @@ class FleurProfile:
         """
         Run inpgen in the given directory
 
+        Relative paths are taken relative to the execution directory
+
         :param directory: path to the execution directory
         :param inputfile: path to the input file for the inpgen
         :param outputfile: path to the file for the stdout output
         :param error_file: path to the file for the stderr output
         """
-        from subprocess import check_call
+        import subprocess
 
-        with open(outputfile, "w", encoding="utf8") as fd:
-            with open(error_file, "w", encoding="utf8") as ferr:
-                check_call(self.inpgen_argv + ["-f", str(inputfile)], stdout=fd, stderr=ferr, cwd=directory)
+        directory = Path(directory)
+        with _output_fds(directory / outputfile, directory / error_file) as (out_fd, err_fd):
+            subprocess.run(
+                self.inpgen_argv + ["-f", str(inputfile)], stdout=out_fd, stderr=err_fd, cwd=directory, check=True
+            )
 
 
 class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
@@ -96,6 +190,18 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
         self.density_converged = 1e-6
         self.force_convergence = {"force_converged": 0.002, "qfix": 2, "forcealpha": 1.0, "forcemix": "straight"}
 
+    def load_profile(self, cfg: Any, **kwargs: Any) -> FleurProfile:
+        """
+        Create the FleurProfile from the ASE configuration. The section
+        of the calculator has to define ``command`` and ``inpgen_command``
+
+        :param cfg: ASE configuration object
+        """
+        import shlex
+
+        section = cfg.parser[self.name]
+        return FleurProfile(shlex.split(section["command"]), shlex.split(section["inpgen_command"]), **kwargs)
+
     def write_input(self, directory: Path, atoms: Atoms, parameters: dict[str, Any], properties: list[str]) -> None:
         """
         Create Fleur inp.xml file from atoms object by calling the
@@ -107,11 +213,45 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
                            Changes to be done after the inpgen was run
                            can be specified in the entry inpxml_changes
         """
+        parameters, inp_changes = self._prepare_parameters(parameters)
+        fm = self._create_modifier(properties, inp_changes)
+        self._write_single_input(Path(directory), atoms, parameters, fm)
 
-        # Sketch
-        # 1. Create inpgen input using the fleur IO format
-        directory = Path(directory)
-        directory.mkdir(exist_ok=True, parents=True)
+    def write_inputs(
+        self, directory: Path, atoms_list: list[Atoms], parameters: dict[str, Any], properties: list[str]
+    ) -> list[Path]:
+        """
+        Create Fleur inp.xml files for multiple atoms objects. Each structure
+        is written to its own numbered subdirectory of the given directory.
+        The inp.xml modifications are only set up once and reused for all structures
+
+        :param directory: path to the base calculation directory
+        :param atoms_list: list of ase.Atoms objects to use
+        :param parameters: Dict with inpgen parameters
+                           Changes to be done after the inpgen was run
+                           can be specified in the entry inpxml_changes
+
+        :returns: list of the calculation directories in the order of the atoms_list
+        """
+        parameters, inp_changes = self._prepare_parameters(parameters)
+        fm = self._create_modifier(properties, inp_changes)
+
+        directories = []
+        for index, atoms in enumerate(atoms_list):
+            subdirectory = Path(directory) / str(index)
+            self._write_single_input(subdirectory, atoms, parameters, fm)
+            directories.append(subdirectory)
+        return directories
+
+    def _prepare_parameters(self, parameters: dict[str, Any]) -> tuple[dict[str, Any], list[Any]]:
+        """
+        Separate the inpgen parameters from the inp.xml changes and
+        make sure that the title is recognized by the inpgen
+
+        :param parameters: Dict with inpgen parameters
+
+        :returns: tuple of the inpgen parameters and the inp.xml changes
+        """
         parameters = dict(parameters)
         inp_changes = parameters.pop("inpxml_changes", [])
         if "title" not in parameters:
@@ -120,19 +260,18 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
             if all(s not in parameters["title"] for s in ("inpgen", "input generator")):
                 warnings.warn("inpgen or inputgenerator has to appear in the inpgen file title. Added to the end")
                 parameters["title"] += " (inpgen)"
+        return parameters, inp_changes
 
-        inputfile = directory / "fleur.in"
-        write_fleur_inpgen(inputfile, atoms, parameters=parameters)
-
-        # 2. Run inpgen
-        self.execute_inpgen(directory, self.inpgen_profile, inputfile)
-
-        # 3. Modify inp.xml according to set parameters
-        fm = FleurXMLModifier()
-        fm.set_inpchanges({"itmax": self.iter_per_run, "mindistance": self.density_converged})
+    def _create_modifier(self, properties: list[str], inp_changes: list[Any]) -> FleurXMLModifier:
+        """
+        Set up the modifications of the inp.xml produced by the inpgen
 
+        :param properties: list of the properties to calculate
+        :param inp_changes: custom task list for the FleurXMLModifier
+        """
+        changes: dict[str, Any] = {"itmax": self.max_runs * self.iter_per_run, "mindistance": self.density_converged}
         if "forces" in properties:
-            fm.set_inpchanges(
+            changes.update(
                 {
                     "force_converged": self.force_convergence["force_converged"],
                     "l_f": True,
@@ -142,26 +281,56 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
                 }
             )
 
-        # 4. ggf. make custom modifications using the FleurXMLmodifier
+        fm = FleurXMLModifier()
+        fm.set_inpchanges(changes)
+
+        # ggf. make custom modifications using the FleurXMLmodifier
         if inp_changes:
             fm.add_task_list(inp_changes)
+        return fm
+
+    def _write_single_input(
+        self, directory: Path, atoms: Atoms, parameters: dict[str, Any], fm: FleurXMLModifier
+    ) -> None:
+        """
+        Write the inpgen input, run the inpgen and apply the
+        modifications to the produced inp.xml
+
+        :param directory: path to the calculation directory
+        :param atoms: ase.Atoms object to use
+        :param parameters: Dict with the prepared inpgen parameters
+        :param fm: FleurXMLModifier with the changes to the inp.xml
+        """
+        # 1. Create inpgen input using the fleur IO format
+        directory.mkdir(exist_ok=True, parents=True)
+        inputfile = directory / "fleur.in"
+        write_fleur_inpgen(inputfile, atoms, parameters=parameters)
 
+        # 2. Run inpgen (inpgen is executed inside the directory)
+        self.execute_inpgen(directory, self.inpgen_profile, Path(inputfile.name))
+
+        # 3. Modify inp.xml according to set parameters
         xmltree, _ = fm.modify_xmlfile(directory / "inp.xml")
-        xmltree.write(directory / "inp.xml", encoding="utf-8", pretty_print=True)
+        # The modifier already indents the tree, so no pretty printing is needed.
+        # Write to a temporary file first to never leave a partially written inp.xml
+        tmpfile = directory / "inp.xml.tmp"
+        xmltree.write(str(tmpfile), encoding="utf-8")
+        os.replace(tmpfile, directory / "inp.xml")
 
     def execute(self, directory: Path, profile: FleurProfile) -> None:
         """
-        Execute Fleur multiple times until the calculation is either converged
+        Execute Fleur until the calculation is either converged
         or a maximum number of iterations is reached
 
+        Fleur stops by itself once the density distance is below the set
+        mindistance, so all iterations are done in a single Fleur run
+        instead of restarting Fleur multiple times
+
         :param directory: Path to the calculation directory
         :param profile: FleurProfile to use
         """
-        converged = False
-        run = 1
-        while not converged and run <= self.max_runs:
-            profile.run(directory, self.stdout_file, self.error_file)
-            converged = self.check_convergence(directory)
+        profile.run(directory, self.stdout_file, self.error_file)
+        self._warn_if_not_converged(directory)
 
     def execute_inpgen(self, directory: Path, profile: FleurProfile, inputfile: Path) -> None:
         """
@@ -173,26 +342,108 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
         """
         profile.run_inpgen(directory, inputfile, self.stdout_file, self.error_file)
 
+    def execute_batch(self, directories: list[Path], profile: FleurProfile, max_workers: int = 1) -> None:
+        """
+        Execute Fleur for multiple prepared calculation directories
+
+        At most ``max_workers`` calculations run at the same time. Each Fleur run
+        can itself use several MPI processes, so by default one calculation is run
+        at a time. If a calculation fails no further calculations are started and
+        the error is raised once the already running calculations have finished
+
+        :param directories: list of paths to the calculation directories
+        :param profile: FleurProfile to use
+        :param max_workers: maximum number of calculations running at the same time
+        """
+        if max_workers < 1:
+            raise ValueError(f"max_workers has to be at least 1, got {max_workers}")
+
+        pending = deque(directories)
+        running: dict[Future, Path] = {}
+        errors: list[BaseException] = []
+        while running or (pending and not errors):
+            while pending and not errors and len(running) < max_workers:
+                directory = pending.popleft()
+                try:
+                    running[profile.run_async(directory, self.stdout_file, self.error_file)] = directory
+                except Exception as err:  # pylint: disable=broad-except
+                    # Collected so that the already running calculations are still waited for
+                    errors.append(err)
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    errors.append(error)
+                    continue
+                try:
+                    self._warn_if_not_converged(directory)
+                except Exception as err:  # pylint: disable=broad-except
+                    # e.g. no out.xml was written, reported after the running calculations
+                    errors.append(err)
+
+        if errors:
+            raise errors[0]
+
+    def _warn_if_not_converged(self, directory: Path) -> None:
+        """
+        Emit a warning if the calculation in the given directory did not converge
+
+        :param directory: Path to the calculation directory
+        """
+        if not self.check_convergence(directory):
+            warnings.warn(
+                f"Fleur calculation in {directory} did not converge within {self.max_runs * self.iter_per_run} iterations"
+            )
+
     def check_convergence(self, directory: Path) -> bool:
         """
         Check if the calculation is converged
 
         :param directory: Path to the calculation directory
         """
-        fleur_results = outxml_parser(directory / self.output_file, iteration_to_parse="all")
+        return self._tail_distance(directory / self.output_file) < self.density_converged
 
-        MAGNETIC_DISTANCE_KEY = "overall_density_convergence"
-        DISTANCE_KEY = "density_convergence"
+    @staticmethod
+    def _tail_distance(path: Path) -> float:
+        """
+        Get the charge density distance of the last iteration in the out.xml
+        file. The file is streamed so that the full XML tree is never built
 
-        distance = fleur_results.get(MAGNETIC_DISTANCE_KEY, fleur_results.get(DISTANCE_KEY))
-        if distance is None:
+        :param path: Path to the out.xml file
+        """
+        from lxml import etree
+        from masci_tools.util.xml.converters import convert_from_fortran_bool
+
+        relax = False
+        distances: deque[float] = deque(maxlen=2)
+        overall_distances: deque[float] = deque(maxlen=2)
+        for _, elem in etree.iterparse(
+            str(path),
+            events=("end",),
+            tag=("geometryOptimization", "chargeDensity", "overallChargeDensity", "iteration"),
+            recover=True,
+        ):
+            if elem.tag == "geometryOptimization":
+                relax = convert_from_fortran_bool(elem.get("l_f", "F"))
+            elif elem.tag == "overallChargeDensity":
+                overall_distances.append(float(elem.get("distance")))
+            elif elem.tag == "chargeDensity":
+                distances.append(float(elem.get("distance")))
+            elif elem.tag == "iteration":
+                # Iterations are already evaluated so they can be dropped
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        if overall_distances:
+            distances = overall_distances
+        if len(distances) < (2 if relax else 1):
             raise ValueError("Could not find charge density distance in output file")
-        if fleur_results["fleur_modes"]["relax"]:
-            distance = distance[-2]
-        else:
-            distance = distance[-1]
-
-        return distance < self.density_converged
+        return distances[-2] if relax else distances[-1]
 
     def read_results(self, directory: Path) -> dict[str, Any]:
         """
@@ -203,6 +454,14 @@ class FleurTemplate(CalculatorTemplate):  # type: ignore[misc]
         atoms = read_fleur_outxml(directory / self.output_file)
         return dict(atoms.calc.properties())
 
+    def read_results_batch(self, directories: list[Path]) -> list[dict[str, Any]]:
+        """
+        Read the calculation results from multiple calculation directories
+
+        :param directories: list of paths to the calculation directories
+        """
+        return [self.read_results(directory) for directory in directories]
+
 
 class Fleur(GenericFileIOCalculator):  # type: ignore[misc]
     """
@@ -216,3 +475,21 @@ class Fleur(GenericFileIOCalculator):  # type: ignore[misc]
         super().__init__(
             template=FleurTemplate(inpgen_profile=profile), profile=profile, directory=directory, parameters=kwargs
         )
+
+    def calculate_batch(
+        self, atoms_list: list[Atoms], properties: list[str] | tuple[str, ...] = ("energy",), max_workers: int = 1
+    ) -> list[dict[str, Any]]:
+        """
+        Run Fleur calculations for multiple structures with the parameters
+        of this calculator. Each structure is calculated in a numbered
+        subdirectory of the calculator directory
+
+        :param atoms_list: list of ase.Atoms objects to calculate
+        :param properties: properties to calculate
+        :param max_workers: maximum number of Fleur calculations running at the same time
+
+        :returns: list of results dicts in the order of the atoms_list
+        """
+        directories = self.template.write_inputs(self.directory, atoms_list, self.parameters, list(properties))
+        self.template.execute_batch(directories, self.profile, max_workers=max_workers)
+        return self.template.read_results_batch(directories)
@@ -12,11 +12,16 @@ The package masci-tools (version 0.4.11 or greater) is required by this module:
 """
 from __future__ import annotations
 import io
+import itertools
+import os
 from pathlib import Path
+from types import MappingProxyType
 
 import numpy as np
+from lxml import etree
 
 from ase.atoms import Atoms
+from ase.data import atomic_numbers
 from ase.calculators.singlepoint import SinglePointDFTCalculator, SinglePointKPoint
 from ase.utils import writer
 from ase.utils.plugins import ExternalIOFormat
@@ -27,12 +32,13 @@ from masci_tools.io.common_functions import convert_to_pystd, AtomSiteProperties
 from masci_tools.util.xml.xml_getters import get_structuredata, get_kpointsdata
 from masci_tools.util.schema_dict_util import (
     eval_simple_xpath,
-    get_number_of_nodes,
     tag_exists,
     evaluate_attribute,
     evaluate_text,
 )
 from masci_tools.util.parse_utils import Conversion
+from masci_tools.util.constants import BOHR_A, FLEUR_DEFINED_CONSTANTS
+from masci_tools.util.fleur_calculate_expression import calculate_expression
 from masci_tools.io.parsers.fleur import outxml_parser, conversion_function
 
 from typing import TextIO, Any, BinaryIO
@@ -46,19 +52,42 @@ inpgen_format = ExternalIOFormat(
     glob="inp_*",
 )
 
+FLEUR_INPUT_MAGIC = b"fleurInputVersion"
+FLEUR_OUTPUT_MAGIC = b"fleurOutputVersion"
+
 xml_format = ExternalIOFormat(
     desc="FLEUR XML input file",
     code="1F",
     module="ase_fleur.io",
-    magic=b"*fleurInputVersion*",
+    magic=b"*" + FLEUR_INPUT_MAGIC + b"*",
 )
 
 outxml_format = ExternalIOFormat(
     desc="FLEUR output XML input file",
     code="1F",
     module="ase_fleur.io",
-    magic=b"*fleurOutputVersion*",
+    magic=b"*" + FLEUR_OUTPUT_MAGIC + b"*",
+)
+
+_SNIFF_SIZE = 4096
+_STREAM_UNSUPPORTED_TAGS = (
+    "filmLattice",
+    "filmPos",
+    "relaxation",
+    "constant",
+    "{http://www.w3.org/2001/XInclude}include",
 )
+_STREAM_STRUCTURE_TAGS = (
+    "fleurInput",
+    "bulkLattice",
+    "row-1",
+    "row-2",
+    "row-3",
+    "species",
+    "atomGroup",
+    "absPos",
+    "relPos",
+) + _STREAM_UNSUPPORTED_TAGS
 
 
 def read_fleur_inpgen(fileobj: TextIO | BinaryIO | Path, index: int = -1) -> Atoms:
@@ -77,9 +106,7 @@ def read_fleur_inpgen(fileobj: TextIO | BinaryIO | Path, index: int = -1) -> Ato
 
     # Last parameter is lapw parameters and is not used here
     cell, atoms, pbc, _ = read_inpgen_file(fileobj)
-    positions, symbols = zip(*[(site.position, site.symbol) for site in atoms])
-
-    return Atoms(symbols=symbols, positions=positions, pbc=pbc, cell=cell)
+    return _sites_to_atoms(atoms, cell, pbc)
 
 
 def read_fleur_xml(fileobj: TextIO | BinaryIO | Path, index: int = -1) -> Atoms:
@@ -96,48 +123,213 @@ def read_fleur_xml(fileobj: TextIO | BinaryIO | Path, index: int = -1) -> Atoms:
         Not used in this implementation.
     """
     try:
-        xmltree, schema_dict = load_outxml(fileobj)
+        return _stream_structure(fileobj)
+    except (ValueError, KeyError, etree.XMLSyntaxError):
+        if isinstance(fileobj, io.IOBase):
+            fileobj.seek(0)
+
+    xmltree, schema_dict = _read_xml_tree(fileobj)
+    return _structure_from_tree(xmltree, schema_dict)
+
+
+def _stream_structure(fileobj: Any) -> Atoms:
+    """
+    Read the structure from a Fleur inp.xml or out.xml by streaming only the
+    input section of the file, without building the full tree or loading the schema
+
+    Only bulk structures given by an explicit Bravais matrix are supported.
+    Films, relaxed positions, user-defined constants and XIncludes raise a ValueError,
+    in which case the full parser has to be used
+
+    :param fileobj: path or seekable file handle positioned at the start of the file
+
+    :returns: Atoms object with the structure
+    """
+    source: Any
+    if isinstance(fileobj, (str, Path)):
+        if not os.path.isfile(fileobj):
+            raise ValueError("Structure can only be streamed from existing files")
+        source = str(fileobj)
+    elif isinstance(fileobj, io.TextIOWrapper) and fileobj.seekable() and fileobj.tell() == 0:
+        source = fileobj.buffer
+    elif isinstance(fileobj, io.BufferedIOBase) and fileobj.seekable():
+        source = fileobj
+    else:
+        raise ValueError("Structure can only be streamed from paths or seekable file handles")
+
+    def evaluate(text: str) -> list[float]:
+        return [calculate_expression(value, FLEUR_DEFINED_CONSTANTS) for value in text.split()]
+
+    scale = None
+    rows: dict[str, list[float]] = {}
+    elements: dict[str, str] = {}
+    abs_positions: list[list[float]] = []
+    rel_positions: list[list[float]] = []
+    groups: list[tuple[str, list[list[float]], list[list[float]]]] = []
+    for _, elem in etree.iterparse(source, events=("end",), tag=_STREAM_STRUCTURE_TAGS):
+        tag = elem.tag
+        if tag in _STREAM_UNSUPPORTED_TAGS:
+            raise ValueError(f"Streaming the structure is not supported for files containing {tag}")
+        if tag == "fleurInput":
+            break
+
+        parent = elem.getparent().tag
+        if tag in ("row-1", "row-2", "row-3"):
+            if parent == "bravaisMatrix":
+                rows[tag] = evaluate(elem.text)
+        elif tag == "bulkLattice":
+            scale = calculate_expression(elem.attrib["scale"], FLEUR_DEFINED_CONSTANTS)
+        elif tag == "species":
+            if parent == "atomSpecies":
+                elements[elem.attrib["name"]] = elem.attrib["element"]
+        elif tag == "absPos":
+            abs_positions.append(evaluate(elem.text))
+        elif tag == "relPos":
+            rel_positions.append(evaluate(elem.text))
+        elif tag == "atomGroup":
+            groups.append((elem.attrib["species"], abs_positions, rel_positions))
+            abs_positions, rel_positions = [], []
+        elem.clear(keep_tail=True)
+
+    if scale is None or len(rows) != 3:
+        raise ValueError("No bulk Bravais matrix found")
+
+    cell = np.array([rows["row-1"], rows["row-2"], rows["row-3"]], dtype=np.float64) * scale * BOHR_A
+
+    numbers = []
+    position_blocks = []
+    for species, absolute, relative in groups:
+        numbers.extend([atomic_numbers[elements[species]]] * (len(absolute) + len(relative)))
+        if absolute:
+            position_blocks.append(np.asarray(absolute, dtype=np.float64) * BOHR_A)
+        if relative:
+            position_blocks.append(np.asarray(relative, dtype=np.float64) @ cell)
+    positions = np.concatenate(position_blocks) if position_blocks else np.empty((0, 3))
+
+    return Atoms(numbers=numbers, positions=positions, pbc=True, cell=cell)
+
+
+def _read_xml_tree(fileobj: Any) -> tuple[Any, Any]:
+    """
+    Parse a Fleur inp.xml or out.xml file with the matching loader
+
+    :param fileobj: path, file handle or parsed xmltree
+
+    :returns: parsed xmltree and the schema dictionary
+    """
+    kind = _detect_fleur_xml_kind(fileobj)
+    if kind == "out":
+        return load_outxml(fileobj)
+    if kind == "inp":
+        return load_inpxml(fileobj)
+
+    try:
+        return load_outxml(fileobj)
     except (ValueError, IndexError):
         if isinstance(fileobj, io.IOBase):
             fileobj.seek(0)
-        xmltree, schema_dict = load_inpxml(fileobj)
+        return load_inpxml(fileobj)
 
+
+def _detect_fleur_xml_kind(fileobj: Any) -> str | None:
+    """
+    Determine whether the given file is a Fleur inp.xml or out.xml
+    by looking at the start of the file
+
+    :param fileobj: path, file handle or parsed xmltree
+
+    :returns: ``"out"``, ``"inp"`` or None if the kind could not be determined
+    """
+    if isinstance(fileobj, etree._ElementTree):
+        return {"fleurOutput": "out", "fleurInput": "inp"}.get(fileobj.getroot().tag)
+
+    if isinstance(fileobj, (str, Path)) and os.path.isfile(fileobj):
+        with open(fileobj, "rb") as f:
+            head = f.read(_SNIFF_SIZE)
+    elif isinstance(fileobj, io.IOBase) and fileobj.seekable():
+        position = fileobj.tell()
+        head = fileobj.read(_SNIFF_SIZE)
+        fileobj.seek(position)
+        if isinstance(head, str):
+            head = head.encode("utf-8")
+    else:
+        return None
+
+    if FLEUR_OUTPUT_MAGIC in head:
+        return "out"
+    if FLEUR_INPUT_MAGIC in head:
+        return "inp"
+    return None
+
+
+def _structure_from_tree(xmltree: Any, schema_dict: Any) -> Atoms:
+    """
+    Create an Atoms object from an already parsed Fleur inp.xml or out.xml
+
+    :param xmltree: parsed xmltree of the file
+    :param schema_dict: schema dictionary corresponding to the file version
+    """
     atoms, cell, pbc = get_structuredata(xmltree, schema_dict)
-    positions, symbols = zip(*[(site.position, site.symbol) for site in atoms])
+    return _sites_to_atoms(atoms, cell, pbc)
 
-    return Atoms(symbols=symbols, positions=positions, pbc=pbc, cell=cell)
 
+def _sites_to_atoms(sites: list[AtomSiteProperties], cell: Any, pbc: Any) -> Atoms:
+    """
+    Create an Atoms object from the list of atom sites returned by masci-tools
 
-OUTXML_ADDITIONAL_TASKS = {
-    "total_energy_ase": {
-        "_minimal": True,
-        "_conversions": [
-            Conversion(
-                name="convert_htr_to_ev",
-                kwargs={
-                    "name": "total_energy",
-                    "converted_name": "total_energy_ev",
-                },
-            )
-        ],
-        "total_energy": {"parse_type": "attrib", "path_spec": {"name": "value", "tag_name": "totalEnergy"}},
-    },
-    "atom_charges": {
-        "_conversions": [Conversion(name="calculate_total_charge_atoms")],
-        "parsed_atom_charges": {
-            "parse_type": "attrib",
-            "path_spec": {"name": "total", "tag_name": "mtCharge", "contains": "valence"},
+    :param sites: list of AtomSiteProperties
+    :param cell: Bravais matrix of the structure
+    :param pbc: periodic boundary conditions of the structure
+    """
+    positions = np.empty((len(sites), 3), dtype=np.float64)
+    numbers = np.empty(len(sites), dtype=int)
+    for i, site in enumerate(sites):
+        positions[i] = site.position
+        numbers[i] = atomic_numbers[site.symbol]
+
+    return Atoms(numbers=numbers, positions=positions, pbc=pbc, cell=cell)
+
+
+OUTXML_ADDITIONAL_TASKS = MappingProxyType(
+    {
+        "total_energy_ase": {
+            "_minimal": True,
+            "_conversions": [
+                Conversion(
+                    name="convert_htr_to_ev",
+                    kwargs={
+                        "name": "total_energy",
+                        "converted_name": "total_energy_ev",
+                    },
+                )
+            ],
+            "total_energy": {"parse_type": "attrib", "path_spec": {"name": "value", "tag_name": "totalEnergy"}},
         },
-        "parsed_corestates": {
-            "parse_type": "allAttribs",
-            "path_spec": {"name": "coreStates"},
-            "kwargs": {
-                "subtags": True,
+        "atom_charges": {
+            "_conversions": [Conversion(name="calculate_total_charge_atoms")],
+            "parsed_atom_charges": {
+                "parse_type": "attrib",
+                "path_spec": {"name": "total", "tag_name": "mtCharge", "contains": "valence"},
+            },
+            "parsed_corestates": {
+                "parse_type": "allAttribs",
+                "path_spec": {"name": "coreStates"},
+                "kwargs": {
+                    "subtags": True,
+                },
+                "flat": False,
             },
-            "flat": False,
         },
-    },
+    }
+)
+_EIGENVALUES_KWARGS: dict[str, Any] = {
+    "filters": {"iteration": {"index": -1}},
+    "iteration_path": True,
+    "list_return": True,
 }
+_ATOMGROUPS = etree.XPath("/fleurOutput/fleurInput/atomGroups/atomGroup")
+_COUNT_RELPOS = etree.XPath("count(relPos)")
+_COUNT_FILMPOS = etree.XPath("count(filmPos)")
 MAGMOMS_KEY = "magnetic_moments"
 MAGMOM_KEY = "total_magnetic_moment_cell"
 FORCES_KEY = "force_atoms"
@@ -162,7 +354,9 @@ def calculate_total_charge_atoms(out_dict: dict[str, Any], logger: Logger) -> di
             logger.warning("calculate_total_charge_atoms got None for corestates")
         return out_dict
 
-    spins = max(corestates["spin"]) if isinstance(corestates["spin"], list) else corestates["spin"]
+    # Fleur writes the core states ordered by spin, so the last entry is the number of spins
+    spin = corestates["spin"]
+    spins = int(spin[-1] if isinstance(spin, list) else spin)
 
     # 1. Calculate the core charges per atomtype
     if not isinstance(corestates["state"], list):
@@ -170,32 +364,29 @@ def calculate_total_charge_atoms(out_dict: dict[str, Any], logger: Logger) -> di
     if spins == 2:
         corestates["state"] = corestates["state"][: len(corestates["state"]) // 2]
 
-    corecharges = []
-    for states in corestates["state"]:
-        weights = states["weight"]
-        if isinstance(weights, list):
-            weights = sum(weights)
-        corecharges.append(weights)
-    corecharges = np.array(corecharges)
+    state_weights = [
+        states["weight"] if isinstance(states["weight"], list) else [states["weight"]] for states in corestates["state"]
+    ]
+    offsets = np.cumsum([0] + [len(weights) for weights in state_weights[:-1]])
+    flat_weights = np.fromiter(itertools.chain.from_iterable(state_weights), dtype=np.float64)
+    corecharges = np.add.reduceat(flat_weights, offsets)
 
     # 2. Calculate the mt charges
     mt_charges = mt_charges[0]
     if not isinstance(mt_charges, list):
         mt_charges = [mt_charges]
 
-    if spins == 2 and len(mt_charges) % 2 != 0:
+    mt_charges = np.asarray(mt_charges, dtype=np.float64)
+    n_types, remainder = divmod(mt_charges.size, spins)
+    if remainder:
         if logger is not None:
             logger.warning("calculate_total_charge_atoms got spins=2 and odd number of mt charges")
         else:
             raise ValueError("calculate_total_charge_atoms got spins=2 and odd number of mt charges")
         return out_dict
 
-    if spins == 2:
-        mt_charges = [
-            charge_up + charge_dn
-            for charge_up, charge_dn in zip(mt_charges[: len(mt_charges) // 2], mt_charges[len(mt_charges) // 2 :])
-        ]
-    mt_charges = np.array(mt_charges)
+    # The mt charges are ordered by spin, so summing the rows folds them per atom type
+    mt_charges = mt_charges.reshape(spins, n_types).sum(axis=0)
 
     atom_charges = convert_to_pystd(mt_charges + corecharges)
     out_dict.setdefault("atom_charges", []).append(atom_charges)
@@ -216,36 +407,31 @@ def read_fleur_outxml(fileobj: TextIO | BinaryIO | Path, index: int = -1, read_e
     index: integer -1
         Not used in this implementation.
     """
-    structure = read_fleur_xml(fileobj)
-
-    if isinstance(fileobj, io.IOBase):
-        fileobj.seek(0)
     xmltree, schema_dict = load_outxml(fileobj)
+    structure = _structure_from_tree(xmltree, schema_dict)
+
     kpoints, weights, cell, pbc = get_kpointsdata(xmltree, schema_dict, only_used=True, convert_to_angstroem=False)
 
-    reciprocal_cell = np.linalg.inv(cell) * 2 * np.pi
-    kpoints_cartesian = np.array(kpoints) @ reciprocal_cell
-    weights = np.array(weights)
-    weights = weights / np.sum(weights)
+    reciprocal_cell = 2 * np.pi * np.linalg.inv(np.asarray(cell, dtype=np.float64))
+    kpoints_cartesian = np.asarray(kpoints, dtype=np.float64) @ reciprocal_cell
+    weights = np.array(weights, dtype=np.float64)
+    weights /= weights.sum()
 
     parser_warnings: dict[str, Any] = {}
     results = outxml_parser(xmltree, parser_info_out=parser_warnings, additional_tasks=OUTXML_ADDITIONAL_TASKS)
 
     # The outxml_parser can only easily supply the charges per atom type for now
     # so we need to blow this up to per atom
-    equivalent_atoms = []
-    atom_groups = eval_simple_xpath(xmltree, schema_dict, "atomGroup", list_return=True)
-    for group in atom_groups:
-        if results["fleur_modes"]["film"]:
-            equivalent_atoms.append(get_number_of_nodes(group, schema_dict, "filmpos"))
-        else:
-            equivalent_atoms.append(get_number_of_nodes(group, schema_dict, "relpos"))
+    atom_groups = _ATOMGROUPS(xmltree)
+    if not atom_groups:
+        atom_groups = eval_simple_xpath(xmltree, schema_dict, "atomGroup", list_return=True)
+    count_positions = _COUNT_FILMPOS if results["fleur_modes"]["film"] else _COUNT_RELPOS
+    equivalent_atoms = [int(count_positions(group)) for group in atom_groups]
 
     atomtype_charges = results.get("atom_charges")
-    atom_charges = []
+    atom_charges = np.array([])
     if atomtype_charges:
         atom_charges = _per_type_to_per_atom(atomtype_charges, equivalent_atoms)
-    atom_charges = np.array(atom_charges)
 
     results_dict = {
         "efermi": results.get("fermi_energy"),
@@ -259,30 +445,28 @@ def read_fleur_outxml(fileobj: TextIO | BinaryIO | Path, index: int = -1, read_e
         magmoms = results[MAGMOMS_KEY]
         if not isinstance(magmoms, list):
             magmoms = [magmoms]
-        results_dict["magmoms"] = np.array(_per_type_to_per_atom(magmoms, equivalent_atoms))
+        results_dict["magmoms"] = _per_type_to_per_atom(magmoms, equivalent_atoms)
         results_dict["magmom"] = results[MAGMOM_KEY]
 
     if FORCES_KEY in results:
-        forces = [force for _, force in results[FORCES_KEY]]
-        results_dict["forces"] = np.array(_per_type_to_per_atom(forces, equivalent_atoms))
+        atomtype_forces = results[FORCES_KEY]
+        forces = np.fromiter(
+            itertools.chain.from_iterable(force for _, force in atomtype_forces),
+            dtype=np.float64,
+            count=3 * len(atomtype_forces),
+        ).reshape(-1, 3)
+        results_dict["forces"] = _per_type_to_per_atom(forces, equivalent_atoms)
 
     kpts = []
     if read_eigenvalues and tag_exists(xmltree, schema_dict, "eigenvalues", iteration_path=True):
-        eigenvalues = eval_simple_xpath(
-            xmltree,
-            schema_dict,
-            "eigenvaluesAt",
-            list_return=True,
-            filters={"iteration": {"index": -1}},
-            iteration_path=True,
-        )
-        for eigval_tag in eigenvalues:
-            spin = evaluate_attribute(eigval_tag, schema_dict, "spin") - 1
-            ikpt = evaluate_attribute(eigval_tag, schema_dict, "ikpt")
+        # Evaluate all eigenvaluesAt tags at once instead of resolving the paths per tag
+        spins = evaluate_attribute(xmltree, schema_dict, "spin", tag_name="eigenvaluesAt", **_EIGENVALUES_KWARGS)
+        ikpts = evaluate_attribute(xmltree, schema_dict, "ikpt", tag_name="eigenvaluesAt", **_EIGENVALUES_KWARGS)
+        eigenvalues = evaluate_text(xmltree, schema_dict, "eigenvaluesAt", **_EIGENVALUES_KWARGS)
+        for spin, ikpt, eig in zip(spins, ikpts, eigenvalues):
             kpt = kpoints_cartesian[ikpt - 1]
             weight = weights[ikpt - 1]
-            eig = evaluate_text(eigval_tag, schema_dict, "eigenvaluesAt")
-            kpts.append(SinglePointKPoint(weight, spin, kpt, eps_n=eig))
+            kpts.append(SinglePointKPoint(weight, spin - 1, kpt, eps_n=eig))
 
     calc = SinglePointDFTCalculator(structure, **results_dict)
     if kpts:
@@ -291,7 +475,7 @@ def read_fleur_outxml(fileobj: TextIO | BinaryIO | Path, index: int = -1, read_e
     return structure
 
 
-def _per_type_to_per_atom(data: list[Any], equiv_atoms: list[int]) -> list[Any]:
+def _per_type_to_per_atom(data: list[Any] | np.ndarray, equiv_atoms: list[int]) -> np.ndarray:
     """
     Transform a quantity from given per atom type to given
     per atom
@@ -301,10 +485,7 @@ def _per_type_to_per_atom(data: list[Any], equiv_atoms: list[int]) -> list[Any]:
 
     :returns: data per atom
     """
-    result = []
-    for per_type, n_equiv in zip(data, equiv_atoms):
-        result.extend([per_type] * n_equiv)
-    return result
+    return np.repeat(np.asarray(data), np.asarray(equiv_atoms, dtype=np.intp), axis=0)
 
 
 @writer
@@ -324,7 +505,11 @@ def write_fleur_inpgen(
     -------
     """
 
-    atom_sites = [AtomSiteProperties(position=atom.position, symbol=atom.symbol, kind=atom.symbol) for atom in atoms]
+    symbols = atoms.get_chemical_symbols()
+    atom_sites = [
+        AtomSiteProperties(position=position, symbol=symbol, kind=symbol)
+        for position, symbol in zip(atoms.get_positions(), symbols)
+    ]
 
     write_inpgen_file(
         atoms.cell,
@@ -3,9 +3,15 @@
 Tests of the fleur calculator class
 """
 from ase.build import bulk
+from pathlib import Path
+from subprocess import CalledProcessError
 import pytest
 import numpy as np
 
+from ase_fleur.calculator import Fleur, FleurProfile, FleurTemplate
+
+TEST_FILES_DIR = Path(__file__).resolve().parent / ".." / "test-files"
+
 
 def verify(calc):
     assert calc.get_fermi_level() is not None
@@ -43,3 +49,135 @@ def test_version(factory):
     Test of version parsing
     """
     assert factory.factory.version() == "6.0"
+
+
+@pytest.mark.calculator("fleur")
+def test_batch(factory):
+    """
+    Test of running multiple structures with one calculator
+    """
+    calc = factory.calc()
+    results = calc.calculate_batch([bulk("Si"), bulk("Si", a=5.5)])
+    assert len(results) == 2
+    assert results[0]["energy"] != pytest.approx(results[1]["energy"])
+
+
+def test_version_stub():
+    """
+    Test of version parsing without the Fleur executable
+    """
+    profile = FleurProfile(["sh", "-c", 'echo "  MaX-Release 6.0 (www.max-centre.eu)"'], [])
+    assert profile.version() == "6.0"
+
+    with pytest.raises(ValueError):
+        FleurProfile(["sh", "-c", "echo no version"], []).version()
+
+    with pytest.raises(CalledProcessError):
+        FleurProfile(["sh", "-c", "exit 2"], []).version()
+
+
+def stub_profile():
+    """
+    Profile copying the test files instead of running inpgen and Fleur
+    """
+    return FleurProfile(
+        ["sh", "-c", f'cp "{TEST_FILES_DIR / "out.xml"}" out.xml'],
+        ["sh", "-c", f'cp "{TEST_FILES_DIR / "inp.xml"}" inp.xml'],
+    )
+
+
+def test_batch_stub(monkeypatch):
+    """
+    Test of the batch lifecycle without the Fleur executables
+    """
+    modifiers = []
+    create_modifier = FleurTemplate._create_modifier
+
+    def _create_modifier(self, *args):
+        modifiers.append(create_modifier(self, *args))
+        return modifiers[-1]
+
+    monkeypatch.setattr(FleurTemplate, "_create_modifier", _create_modifier)
+
+    calc = Fleur(profile=stub_profile(), directory="calc")
+    calc.template.density_converged = 1.0
+    results = calc.calculate_batch([bulk("Si"), bulk("Si", a=5.5)])
+
+    assert len(modifiers) == 1
+    assert len(results) == 2
+    assert results[0]["energy"] == pytest.approx(-15784.360931872383)
+    for index in ("0", "1"):
+        assert sorted(path.name for path in (Path("calc") / index).iterdir()) == [
+            "error.log",
+            "fleur.in",
+            "fleur.log",
+            "inp.xml",
+            "out.xml",
+        ]
+    assert not Path("fleur.log").exists()
+    assert not Path("error.log").exists()
+
+
+def test_run_async(tmp_path):
+    """
+    Test of running Fleur asynchronously without the Fleur executable
+    """
+    profile = FleurProfile(["sh", "-c", "echo output; echo error >&2"], [])
+    assert profile.run_async(tmp_path, "fleur.log", "error.log").result(timeout=10) is None
+    assert (tmp_path / "fleur.log").read_text() == "output\n"
+    assert (tmp_path / "error.log").read_text() == "error\n"
+
+    profile = FleurProfile(["sh", "-c", "exit 3"], [])
+    with pytest.raises(CalledProcessError) as excinfo:
+        profile.run_async(tmp_path, "fleur.log", "error.log").result(timeout=10)
+    assert excinfo.value.returncode == 3
+
+
+@pytest.mark.parametrize(
+    "max_workers, markers, error, finished",
+    [
+        (1, {"0": "fail"}, CalledProcessError, []),
+        (3, {"1": "fail"}, CalledProcessError, ["0", "2"]),
+        (2, {"0": "empty", "1": "slow"}, FileNotFoundError, ["1"]),
+    ],
+)
+def test_execute_batch_error(tmp_path, max_workers, markers, error, finished):
+    """
+    Test that a failing calculation stops the batch only after the running calculations finished
+    """
+    profile = FleurProfile(
+        [
+            "sh",
+            "-c",
+            "if [ -e fail ]; then exit 3; fi; if [ -e empty ]; then exit 0; fi; if [ -e slow ]; then sleep 1; fi; "
+            f'cp "{TEST_FILES_DIR / "out.xml"}" out.xml',
+        ],
+        [],
+    )
+    template = FleurTemplate(inpgen_profile=profile)
+    template.density_converged = 1.0
+
+    directories = [tmp_path / str(index) for index in range(3)]
+    for directory in directories:
+        directory.mkdir()
+    for name, marker in markers.items():
+        (tmp_path / name / marker).touch()
+
+    with pytest.raises(error):
+        template.execute_batch(directories, profile, max_workers=max_workers)
+
+    assert sorted(directory.name for directory in directories if (directory / "out.xml").exists()) == finished
+
+
+@pytest.mark.parametrize(
+    "filename, distance",
+    [
+        ("out.xml", 0.026112816),
+        ("out_magnetic.xml", 2.65528e-05),
+    ],
+)
+def test_tail_distance(filename, distance):
+    """
+    Test of the streamed convergence check
+    """
+    assert FleurTemplate._tail_distance(TEST_FILES_DIR / filename) == pytest.approx(distance)
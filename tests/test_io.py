@@ -34,6 +34,66 @@ def test_read_fleur_xml():
     assert atoms.cell[:] == pytest.approx(np.array([[0.0, param, param], [param, 0.0, param], [param, param, 0.0]]))
 
 
+@pytest.mark.parametrize("mode", ["r", "rb"])
+@pytest.mark.parametrize("filename", ["inp.xml", "out.xml"])
+def test_read_fleur_xml_fileobj(filename, mode):
+    from ase_fleur.io import read_fleur_xml
+
+    with open(TEST_FILES_DIR / filename, mode) as f:
+        atoms = read_fleur_xml(f)
+
+    assert all(atoms.symbols == "Si")
+    assert all(atoms.pbc)
+
+
+def test_read_fleur_xml_content():
+    from ase_fleur.io import read_fleur_xml
+
+    with pytest.warns(UserWarning, match="base_url"):
+        atoms = read_fleur_xml((TEST_FILES_DIR / "inp.xml").read_text())
+
+    assert not compare_atoms(atoms, read(TEST_FILES_DIR / "inp.xml"), tol=1e-10)
+
+
+@pytest.mark.parametrize("filename", ["inp.xml", "out.xml", "out_magnetic.xml"])
+def test_stream_structure(filename):
+    from ase_fleur.io import _stream_structure, _read_xml_tree, _structure_from_tree
+
+    streamed = _stream_structure(TEST_FILES_DIR / filename)
+    parsed = _structure_from_tree(*_read_xml_tree(TEST_FILES_DIR / filename))
+
+    assert not compare_atoms(streamed, parsed, tol=1e-10)
+
+
+def test_read_fleur_xml_fallback(tmp_path):
+    from ase_fleur.io import read_fleur_xml, _stream_structure
+
+    content = (TEST_FILES_DIR / "inp.xml").read_text()
+    content = content.replace(
+        "   </comment>\n",
+        '   </comment>\n   <constants>\n      <constant name="Pos" value=".1250000000"/>\n   </constants>\n',
+        1,
+    )
+    content = content.replace(">1.000/8.000 1.000/8.000 1.000/8.000<", ">Pos Pos Pos<")
+    (tmp_path / "inp.xml").write_text(content)
+
+    with pytest.raises(ValueError):
+        _stream_structure(tmp_path / "inp.xml")
+
+    atoms = read_fleur_xml(tmp_path / "inp.xml")
+    assert not compare_atoms(atoms, read(TEST_FILES_DIR / "inp.xml"), tol=1e-10)
+
+
+def test_read_fleur_outxml_fileobj():
+    from ase_fleur.io import read_fleur_outxml
+
+    with open(TEST_FILES_DIR / "out.xml", "rb") as f:
+        atoms = read_fleur_outxml(f)
+
+    assert all(atoms.symbols == "Si")
+    assert atoms.calc.results["energy"] == pytest.approx(-15784.360931872383)
+
+
 def test_read_fleur_outxml():
     atoms = read(TEST_FILES_DIR / "out.xml")
 